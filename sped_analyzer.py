@@ -14,15 +14,20 @@ Como executar localmente:
 
 from __future__ import annotations
 
+import array
+import functools
 import io
 import os
 import re
+import sys
 import unicodedata
 import tempfile
 import zipfile
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict, List, Optional, Iterable
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
@@ -30,42 +35,68 @@ import streamlit as st
 # Utilidades e normalização
 # -------------------------
 
+# Separadores tratados como espaço em norm_text; após a redução a ASCII,
+# translate + split/join equivalem ao antigo re.sub(r'[\s\./\-_,]+', ' ')
+# sem o custo do motor de regex por chamada
+_SEP_TABLE = str.maketrans('./-_,', '     ')
+# Compilado uma vez no import, para a limpeza de nomes de coluna da TIPI
+_NONALNUM_RE = re.compile(r'[^A-Z0-9]')
+
 def norm_text(s: str) -> str:
     if s is None:
         return ''
     s = unicodedata.normalize('NFKD', s)
     s = s.encode('ascii', 'ignore').decode('utf-8')
-    s = s.lower()
-    s = re.sub(r'[\s\./\-_,]+', ' ', s).strip()
-    return s
+    return ' '.join(s.lower().translate(_SEP_TABLE).split())
 
 def parse_float_br(value: str) -> float:
+    # Chamada ~20x por linha no parse; os testes de pertinência evitam as
+    # realocações de str.replace no caso comum (campo sem milhar/decimal)
     if not value:
         return 0.0
     value = value.strip()
     if not value:
         return 0.0
-    value = value.replace('.', '').replace(',', '.')
+    if '.' in value:
+        value = value.replace('.', '')
+    if ',' in value:
+        value = value.replace(',', '.')
     try:
         return float(value)
     except Exception:
         return 0.0
 
-def detect_encoding_from_bytes(b: bytes) -> str:
-    try:
-        import chardet  # type: ignore
-    except Exception:
+# Campos de alíquota repetem um conjunto minúsculo de literais ('18,00',
+# '4,00', '12,00'...); memoizar só esses campos poupa a conversão sem
+# poluir o cache com valores monetários praticamente únicos
+parse_aliq_br = functools.lru_cache(maxsize=1024)(parse_float_br)
+
+@functools.lru_cache(maxsize=256)
+def _detect_encoding_sig(sig: bytes) -> str:
+    # O vocabulário do SPED é ASCII + acentos latinos: ou o arquivo é
+    # UTF-8 válido, ou é latin-1 (o padrão da especificação). Isso torna
+    # o chardet (puro Python, caro) desnecessário: amostra ASCII vai de
+    # latin-1 (decodificação 1:1), UTF-8 se prova decodificando, e
+    # qualquer falha cai no latin-1, que aceita todo byte
+    if sig.isascii():
         return 'latin-1'
+    if sig.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
     try:
-        result = chardet.detect(b[:20000])
-        enc = (result.get('encoding') or 'latin-1').lower()
-        conf = float(result.get('confidence') or 0.0)
-        if conf < 0.7 or enc in {'ascii'}:
-            return 'latin-1'
-        return enc
-    except Exception:
+        sig.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as exc:
+        # Erro só nos últimos bytes = sequência multibyte cortada pela
+        # amostragem, não evidência contra UTF-8
+        if exc.start >= len(sig) - 3:
+            return 'utf-8'
         return 'latin-1'
 
+def detect_encoding_from_bytes(b: bytes) -> str:
+    # chardet satura com poucos KB; amostrar 4KB e memoizar pela assinatura
+    # evita redetectar em lotes de arquivos vindos do mesmo ERP
+    return _detect_encoding_sig(bytes(b[:4096]))
+
 # -------------------------
 # TIPI
 # -------------------------
@@ -74,7 +105,12 @@ def load_tipi_table(path: str) -> Dict[str, float]:
     if not path:
         return {}
     if path.lower().endswith('.xlsx'):
-        df = pd.read_excel(path)
+        # calamine (pip install python-calamine) lê XLSX por streaming e é
+        # muito mais rápido que o openpyxl; na ausência dele, usa o padrão
+        try:
+            df = pd.read_excel(path, engine='calamine')
+        except ImportError:
+            df = pd.read_excel(path)
     elif path.lower().endswith('.csv'):
         # TIPI CSV geralmente ; e , como decimal
         df = pd.read_csv(path, sep=';', decimal=',')
@@ -86,39 +122,61 @@ def load_tipi_table(path: str) -> Dict[str, float]:
         nc = unicodedata.normalize('NFKD', col)
         nc = nc.encode('ascii', 'ignore').decode('utf-8')
         nc = nc.upper().strip()
-        nc = re.sub(r'[^A-Z0-9]', '', nc)
+        nc = _NONALNUM_RE.sub('', nc)
         cols[col] = nc
     df = df.rename(columns=cols)
     if 'NCM' not in df.columns or 'ALIQUOTA' not in df.columns:
         raise KeyError("TIPI precisa conter colunas 'NCM' e 'ALIQUOTA'")
-    m: Dict[str, float] = {}
-    for _, row in df.iterrows():
-        ncm = str(row['NCM']).strip()
-        if not ncm:
-            continue
-        try:
-            aliq = float(str(row['ALIQUOTA']).replace(',', '.'))
-        except Exception:
-            continue
-        m[ncm] = aliq
-    return m
+    # Conversão vetorizada coluna a coluna (iterrows materializa uma Series
+    # por linha e domina o tempo de carga em TIPIs com dezenas de milhares
+    # de NCMs); linhas sem NCM ou com alíquota inválida caem pela máscara
+    ncm = df['NCM'].astype(str).str.strip()
+    aliq = pd.to_numeric(
+        df['ALIQUOTA'].astype(str).str.replace(',', '.', regex=False),
+        errors='coerce')
+    mask = (ncm != '') & (ncm != 'nan') & aliq.notna()
+    return dict(zip(ncm[mask].tolist(), aliq[mask].tolist()))
 
 # -------------------------
 # XML (NF-e e CT-e)
 # -------------------------
 
+# lxml (quando disponível) é mais rápido e aguenta XMLs enormes/malformados;
+# o parser é criado uma vez e reutilizado, com entidades/rede desabilitadas
+# por se tratar de XML vindo de fora. Sem lxml, cai no ElementTree da stdlib.
+try:
+    from lxml import etree as LET  # type: ignore
+    _XML_PARSER = LET.XMLParser(
+        huge_tree=True, remove_blank_text=True, collect_ids=False,
+        resolve_entities=False, no_network=True,
+    )
+    def _xml_root(b: bytes):
+        return LET.fromstring(bytes(b), _XML_PARSER)
+except Exception:
+    LET = None
+    def _xml_root(b: bytes):
+        return ET.fromstring(b)
+
 def parse_xml_nfe_bytes(b: bytes) -> Optional[Dict[str, any]]:
     try:
-        root = ET.fromstring(b)
+        root = _xml_root(b)
         ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}
         data: Dict[str, any] = {}
-        inf = root.find('.//nfe:infNFe', ns)
-        if inf is not None:
-            key = inf.get('Id')
-            if key and key.startswith('NFe'):
-                key = key[3:]
-            data['Chave'] = key
-        tot = root.find('.//nfe:ICMSTot', ns)
+        # O wrapper varia (nfeProc > NFe > infNFe ou NFe direto); localizado
+        # o infNFe, o schema fixa os filhos — navegar por caminho direto a
+        # partir dele evita revarrer o documento inteiro a cada './/'
+        inf = root.find('./nfe:NFe/nfe:infNFe', ns)
+        if inf is None:
+            inf = root.find('./nfe:infNFe', ns)
+        if inf is None:
+            inf = root.find('.//nfe:infNFe', ns)
+        if inf is None:
+            return None
+        key = inf.get('Id')
+        if key and key.startswith('NFe'):
+            key = key[3:]
+        data['Chave'] = key
+        tot = inf.find('nfe:total/nfe:ICMSTot', ns)
         if tot is not None:
             def f(tag):
                 el = tot.find(f'nfe:{tag}', ns)
@@ -126,13 +184,13 @@ def parse_xml_nfe_bytes(b: bytes) -> Optional[Dict[str, any]]:
             data['Valor ICMS XML'] = f('vICMS')
             data['Valor IPI XML'] = f('vIPI')
             data['Valor Produtos XML'] = f('vProd')
-        emit = root.find('.//nfe:emit', ns)
+        emit = inf.find('nfe:emit', ns)
         if emit is not None:
             xNome = emit.find('nfe:xNome', ns)
             cnpj  = emit.find('nfe:CNPJ', ns)
             data['Emitente XML'] = xNome.text if xNome is not None else 'N/A'
             data['CNPJ Emitente XML'] = cnpj.text if cnpj is not None else 'N/A'
-        dest = root.find('.//nfe:dest', ns)
+        dest = inf.find('nfe:dest', ns)
         if dest is not None:
             xNome = dest.find('nfe:xNome', ns)
             cnpj  = dest.find('nfe:CNPJ', ns)
@@ -142,122 +200,740 @@ def parse_xml_nfe_bytes(b: bytes) -> Optional[Dict[str, any]]:
     except Exception:
         return None
 
+# Tipos de tomador do serviço (infCte/ide/toma3/toma)
+_CTE_TOMA_TIPOS = {'0': 'Remetente', '1': 'Expedidor', '2': 'Recebedor', '3': 'Destinatário'}
+
 def parse_xml_cte_bytes(b: bytes) -> Optional[Dict[str, any]]:
     try:
-        root = ET.fromstring(b)
+        root = _xml_root(b)
         ns = {'cte': 'http://www.portalfiscal.inf.br/cte'}
         data: Dict[str, any] = {}
         infCte = root.find('.//cte:infCte', ns)
-        if infCte is not None:
-            key = infCte.get('Id')
-            if key and key.startswith('CTe'):
-                key = key[3:]
-            data['Chave'] = key
-        vPrest = root.find('.//cte:vPrest', ns)
+        if infCte is None:
+            return None
+        key = infCte.get('Id')
+        if key and key.startswith('CTe'):
+            key = key[3:]
+        data['Chave'] = key
+        # O schema do CT-e fixa os filhos de infCte; navegar por caminho
+        # direto a partir dele evita varreduras './/' do documento inteiro
+        vPrest = infCte.find('cte:vPrest', ns)
         if vPrest is not None:
             v = vPrest.find('cte:vTPrest', ns)
             data['Valor Total Prestação XML'] = float(v.text) if v is not None and v.text else 0.0
-        icms = root.find('.//cte:ICMS/cte:ICMSOutraUF', ns)
+        # O grupo ICMS carrega exatamente um filho ICMSxx (ICMS00,
+        # ICMSOutraUF, ICMS90...); em vez de tentar cada variante com um
+        # find próprio, lê o filho único direto e escolhe os nomes de
+        # campo (com/sem sufixo OutraUF) pela tag encontrada
+        icms_group = infCte.find('cte:imp/cte:ICMS', ns)
+        icms = None
+        if icms_group is not None:
+            for child in icms_group:
+                if isinstance(child.tag, str):
+                    icms = child
+                    break
         if icms is not None:
+            suf = 'OutraUF' if icms.tag.endswith('ICMSOutraUF') else ''
             def f(tag):
                 el = icms.find(f'cte:{tag}', ns)
                 return float(el.text) if el is not None and el.text else 0.0
-            data['BC ICMS XML'] = f('vBCOutraUF')
-            data['Valor ICMS XML'] = f('vICMSOutraUF')
-            data['Alíquota ICMS XML'] = f('pICMSOutraUF')
+            data['BC ICMS XML'] = f('vBC' + suf)
+            data['Valor ICMS XML'] = f('vICMS' + suf)
+            data['Alíquota ICMS XML'] = f('pICMS' + suf)
             cst = icms.find('cte:CST', ns)
             data['CST XML'] = cst.text if cst is not None else 'N/A'
         else:
-            anytag = None
-            for t in ['ICMS00','ICMS20','ICMS90','ICMS40','ICMS51','ICMS60','ICMS70','ICMSPart','ICMSST','ICMSCons','ICMSUFDest']:
-                anytag = root.find(f'.//cte:ICMS/cte:{t}', ns)
-                if anytag is not None:
-                    break
-            if anytag is not None:
-                def f(tag):
-                    el = anytag.find(f'cte:{tag}', ns)
-                    return float(el.text) if el is not None and el.text else 0.0
-                data['BC ICMS XML'] = f('vBC')
-                data['Valor ICMS XML'] = f('vICMS')
-                data['Alíquota ICMS XML'] = f('pICMS')
-                cst = anytag.find('cte:CST', ns)
-                data['CST XML'] = cst.text if cst is not None else 'N/A'
-            else:
-                data['BC ICMS XML'] = 0.0
-                data['Valor ICMS XML'] = 0.0
-                data['Alíquota ICMS XML'] = 0.0
-                data['CST XML'] = 'N/A'
-        toma3 = root.find('.//cte:toma3/cte:toma', ns)
+            data['BC ICMS XML'] = 0.0
+            data['Valor ICMS XML'] = 0.0
+            data['Alíquota ICMS XML'] = 0.0
+            data['CST XML'] = 'N/A'
+        toma3 = infCte.find('cte:ide/cte:toma3/cte:toma', ns)
         toma_value = toma3.text if toma3 is not None else ''
-        tipo = 'Não Identificado'
-        if toma_value == '0': tipo = 'Remetente'
-        elif toma_value == '1': tipo = 'Expedidor'
-        elif toma_value == '2': tipo = 'Recebedor'
-        elif toma_value == '3': tipo = 'Destinatário'
-        data['Tipo Tomador XML'] = tipo
-        emit = root.find('.//cte:emit', ns)
+        data['Tipo Tomador XML'] = _CTE_TOMA_TIPOS.get(toma_value, 'Não Identificado')
+        emit = infCte.find('cte:emit', ns)
         if emit is not None:
             xNome = emit.find('cte:xNome', ns); cnpj = emit.find('cte:CNPJ', ns)
             data['Emitente XML'] = xNome.text if xNome is not None else 'N/A'
             data['CNPJ Emitente XML'] = cnpj.text if cnpj is not None else 'N/A'
-        dest = root.find('.//cte:dest', ns)
+        dest = infCte.find('cte:dest', ns)
         if dest is not None:
             xNome = dest.find('cte:xNome', ns); cnpj = dest.find('cte:CNPJ', ns)
             data['Destinatário XML'] = xNome.text if xNome is not None else 'N/A'
             data['CNPJ Destinatário XML'] = cnpj.text if cnpj is not None else 'N/A'
-        return data if 'Chave' in data else None
+        return data if data.get('Chave') else None
     except Exception:
         return None
 
+def parse_xml_doc_bytes(b: bytes) -> Optional[Dict[str, any]]:
+    """Interpreta um documento fiscal (NF-e ou CT-e) e devolve seus dados.
+
+    O namespace nos primeiros KB do arquivo decide o parser; antes o CT-e
+    era sempre parseado duas vezes (tentativa NF-e falha + reparse CT-e).
+    O sniff ambíguo cai no comportamento antigo de tentar os dois.
+    """
+    head = bytes(b[:2048])
+    if b'portalfiscal.inf.br/nfe' in head:
+        d = parse_xml_nfe_bytes(b)
+    elif b'portalfiscal.inf.br/cte' in head:
+        d = parse_xml_cte_bytes(b)
+    else:
+        d = parse_xml_nfe_bytes(b)
+        if not d or not d.get('Chave'):
+            d = parse_xml_cte_bytes(b)
+    return d if d and d.get('Chave') else None
+
+def _iter_xml_blobs(named_blobs: Iterable[tuple]) -> Iterable[bytes]:
+    """Gera os bytes de cada documento XML de pares (nome, bytes): .xml soltos e ZIPs."""
+    seen: set = set()
+    for name, data in named_blobs:
+        low = name.lower()
+        if low.endswith('.xml'):
+            yield bytes(data)
+        elif low.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                    infos = []
+                    for info in zf.infolist():
+                        if not info.filename.lower().endswith('.xml'):
+                            continue
+                        # Pacotes reais repetem a mesma nota em subpastas
+                        # (backup, eventos); o CRC+tamanho do diretório
+                        # central identifica a duplicata sem descompactar
+                        sig = (info.CRC, info.file_size)
+                        if sig in seen:
+                            continue
+                        seen.add(sig)
+                        infos.append(info)
+                    if len(infos) <= 32:
+                        for info in infos:
+                            try:
+                                yield zf.read(info)
+                            except Exception:
+                                pass
+                    else:
+                        # A descompactação zlib libera o GIL, então um
+                        # pool de threads extrai os milhares de membros
+                        # de pacotes grandes em paralelo (leituras
+                        # concorrentes do mesmo ZipFile são seguras)
+                        def _read(info):
+                            try:
+                                return zf.read(info)
+                            except Exception:
+                                return None
+                        with ThreadPoolExecutor(max_workers=8) as tp:
+                            for blob in tp.map(_read, infos):
+                                if blob is not None:
+                                    yield blob
+            except Exception:
+                pass
+
+def xml_map_from_blobs(named_blobs: Iterable[tuple],
+                       workers: Optional[int] = None) -> Dict[str, Dict[str, any]]:
+    """Monta o índice chave -> dados dos XMLs, em paralelo quando há muitos.
+
+    Recebe pares (nome, bytes), como parse_sped_many. O parse de cada
+    documento é CPU puro e independente; acima de algumas dezenas de
+    arquivos vale pagar o fan-out por processo. Lotes pequenos seguem no
+    processo principal.
+    """
+    blobs = list(_iter_xml_blobs(named_blobs))
+    res: Dict[str, Dict[str, any]] = {}
+    if len(blobs) <= 32:
+        for blob in blobs:
+            try:
+                d = parse_xml_doc_bytes(blob)
+            except Exception:
+                d = None
+            if d:
+                res[d['Chave']] = d
+        return res
+    max_workers = workers or min(len(blobs), os.cpu_count() or 1)
+    chunksize = max(1, len(blobs) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        for d in ex.map(parse_xml_doc_bytes, blobs, chunksize=chunksize):
+            if d:
+                res[d['Chave']] = d
+    return res
+
 # -------------------------
 # Estruturas
 # -------------------------
 
+# Tabelas acumuladas durante o parse. Cada tabela é armazenada em formato
+# colunar (SoA): um dict {coluna: lista alinhada} em vez de lista de dicts,
+# o que reduz o número de objetos Python e permite construir os DataFrames
+# diretamente das colunas, sem a varredura de união de chaves de
+# pd.DataFrame(list_of_dicts).
+SPED_TABLES = (
+    'entries', 'outputs', 'items', 'imob_uso', 'cte', 'adjustments',
+    'st_blocks', 'difal_blocks', 'ipi_blocks', 'missing_c190',
+)
+
+# Colunas de valores/alíquotas: convertidas para float já na construção do
+# DataFrame, para que colunas com None (p.ex. cruzamento XML sem match) não
+# desçam como dtype object até os groupbys e o Excel
+_NUMERIC_COLUMNS = frozenset({
+    'Valor Total Nota', 'BC ICMS Nota', 'Valor ICMS Nota', 'Valor IPI Nota',
+    'Valor Total Item', 'BC ICMS Item', 'Alíquota ICMS Item (%)', 'Valor ICMS Item',
+    'Alíq. Efetiva (%)', 'Alíquota IPI Item (%)', 'Valor IPI Item',
+    'Alíquota ICMS', 'Valor Operação', 'BC ICMS', 'Valor ICMS', 'Valor Ajuste',
+    'Valor Total CT-e', 'BC ICMS CT-e', 'Valor ICMS CT-e', 'Alíquota ICMS CT-e',
+    'Valor Operação CT-e', 'BC ICMS CT-e (D190)', 'Valor ICMS CT-e (D190)',
+    'Alíq. Efetiva CT-e (%)', 'Valor IPI CT-e', 'Valor Recolhimento',
+    'Valor ICMS XML', 'Valor IPI XML', 'Valor Produtos XML',
+})
+
+_NAN = float('nan')
+
+def _new_column(name: str, n: int):
+    """Cria a coluna vazia adequada, já preenchida para n linhas anteriores.
+
+    Colunas numéricas usam array.array('d') — 8 bytes por valor em vez de
+    um float boxed, e viram ndarray sem cópia na montagem do DataFrame.
+    """
+    if name in _NUMERIC_COLUMNS:
+        return array.array('d', [_NAN]) * n if n else array.array('d')
+    return [None] * n
+
 class SpedRecord:
     def __init__(self, file_name: str):
         self.file_name = file_name
-        self.entries: List[dict] = []
-        self.outputs: List[dict] = []
-        self.items: List[dict] = []
-        self.imob_uso: List[dict] = []
-        self.cte: List[dict] = []
-        self.adjustments: List[dict] = []
-        self.st_blocks: List[dict] = []
-        self.difal_blocks: List[dict] = []
-        self.ipi_blocks: List[dict] = []
-        self.missing_c190: List[dict] = []
+        self.tables: Dict[str, Dict[str, list]] = {t: {} for t in SPED_TABLES}
+        self.row_counts: Dict[str, int] = {t: 0 for t in SPED_TABLES}
         self.master_data: dict = {}
         self.block_flags: dict = {}
         self.parsing_warnings: List[str] = []
 
+    def append_row(self, table: str, row: Dict[str, any]) -> None:
+        """Acrescenta uma linha à tabela, espalhando os valores por coluna.
+
+        Colunas ausentes na linha (ou vistas pela primeira vez) são
+        preenchidas com None para manter todas as listas alinhadas.
+        """
+        cols = self.tables[table]
+        n = self.row_counts[table]
+        for key, value in row.items():
+            col = cols.get(key)
+            if col is None:
+                col = cols[key] = _new_column(key, n)
+            col.append(value)
+        if n or len(cols) > len(row):
+            target = n + 1
+            for col in cols.values():
+                if len(col) < target:
+                    col.append(_NAN if isinstance(col, array.array) else None)
+        self.row_counts[table] = n + 1
+
+    def table_frame(self, table: str) -> pd.DataFrame:
+        data = {
+            key: np.frombuffer(col, dtype=np.float64) if isinstance(col, array.array) else col
+            for key, col in self.tables[table].items()
+        }
+        df = pd.DataFrame(data)
+        for col in df.columns:
+            if col in _NUMERIC_COLUMNS and df[col].dtype == object:
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+        return df
+
     def extend(self, other: 'SpedRecord'):
-        self.entries += other.entries
-        self.outputs += other.outputs
-        self.items += other.items
-        self.imob_uso += other.imob_uso
-        self.cte += other.cte
-        self.adjustments += other.adjustments
-        self.st_blocks += other.st_blocks
-        self.difal_blocks += other.difal_blocks
-        self.ipi_blocks += other.ipi_blocks
-        self.missing_c190 += other.missing_c190
+        for table, other_cols in other.tables.items():
+            n_other = other.row_counts[table]
+            if not n_other:
+                continue
+            cols = self.tables[table]
+            n_self = self.row_counts[table]
+            for key in other_cols:
+                if key not in cols:
+                    cols[key] = _new_column(key, n_self)
+            for key, col in cols.items():
+                other_col = other_cols.get(key)
+                if other_col is None or not len(other_col):
+                    other_col = ([_NAN] if isinstance(col, array.array) else [None]) * n_other
+                col.extend(other_col)
+            self.row_counts[table] = n_self + n_other
         self.parsing_warnings += other.parsing_warnings
 
+# Tabelas e colunas (numerador, denominador) da alíquota efetiva de ICMS
+_EFF_RATE_SPECS = (
+    (('items', 'entries', 'imob_uso'), 'Valor ICMS Item', 'Valor Total Item'),
+    (('outputs',), 'Valor ICMS', 'BC ICMS'),
+)
+
+def compute_effective_rates(rec: 'SpedRecord') -> None:
+    """Calcula 'Alíq. Efetiva (%)' em lote, tabela a tabela, após o parse.
+
+    Os handlers gravam 0.0 na coluna; aqui uma divisão NumPy sobre os
+    buffers array('d') substitui o branch e a divisão por linha do loop.
+    """
+    for tables, num_key, den_key in _EFF_RATE_SPECS:
+        for table in tables:
+            cols = rec.tables[table]
+            num = cols.get(num_key); den = cols.get(den_key)
+            if num is None or den is None or 'Alíq. Efetiva (%)' not in cols:
+                continue
+            num = np.frombuffer(num, dtype=np.float64)
+            den = np.frombuffer(den, dtype=np.float64)
+            eff = np.zeros(len(den))
+            np.divide(num, den, out=eff, where=den > 0)
+            eff *= 100.0
+            cols['Alíq. Efetiva (%)'] = array.array('d', eff)
+
+def compute_ipi_conformity(cols: Dict[str, list], tipi: Dict[str, float]) -> None:
+    """Classifica a conformidade IPI x TIPI de uma tabela colunar de itens.
+
+    Executada uma única vez após o parse, em NumPy, em vez de comparar
+    alíquota a alíquota dentro do loop de C170.
+    """
+    aliqs = cols.get('Alíquota IPI Item (%)')
+    if not aliqs:
+        return
+    aliq = pd.to_numeric(pd.Series(aliqs), errors='coerce').fillna(0.0).to_numpy(dtype=float)
+    status = np.empty(len(aliq), dtype=object)
+    zero = aliq == 0.0
+    status[zero] = 'Conforme'
+    pending = ~zero
+    if not tipi:
+        status[pending] = 'TIPI não carregada'
+    else:
+        ncm = pd.Series(cols.get('NCM Item'), dtype=object).fillna('').to_numpy()
+        no_ncm = pending & (ncm == '')
+        status[no_ncm] = 'NCM não encontrado'
+        expected = pd.to_numeric(pd.Series(ncm, dtype=object).map(tipi), errors='coerce').to_numpy(dtype=float)
+        unknown = pending & ~no_ncm & np.isnan(expected)
+        status[unknown] = 'NCM não encontrado na TIPI'
+        known = pending & ~no_ncm & ~unknown
+        ok = known & (np.abs(aliq - np.where(np.isnan(expected), 0.0, expected)) < 0.001)
+        status[ok] = 'Conforme'
+        for i in np.flatnonzero(known & ~ok):
+            status[i] = f'Divergente (TIPI: {expected[i]:.2f}%)'
+    cols['Conformidade IPI x TIPI'] = status.tolist()
+
 # -------------------------
 # Parser SPED (leitura em memória)
 # -------------------------
 
-def parse_sped_bytes(file_name: str, data: bytes, xml_map: Dict[str, Dict[str, any]], tipi: Dict[str, float]) -> SpedRecord:
+# Registros efetivamente tratados no loop principal. Linhas fora deste
+# conjunto (0150, 0190, C500, H010, ...) são descartadas com um único
+# startswith, sem pagar o split('|'). Os prefixos abertos '|E2'/'|E3'
+# cobrem as flags de presença dos blocos E200/E300.
+_HANDLED_PREFIXES = (
+    '|0000|', '|0002|', '|0005|', '|0015|', '|0100|',
+    '|C100|', '|C170|', '|C190|', '|C195|', '|C197|',
+    '|D100|', '|D190|', '|E111|', '|E115|', '|E116|',
+    '|G110|', '|E2', '|E3',
+)
+# O gate roda sobre as linhas ainda em bytes: só os registros tratados são
+# decodificados para str, o resto do arquivo nem passa pelo codec
+_HANDLED_PREFIXES_B = tuple(p.encode('ascii') for p in _HANDLED_PREFIXES)
+
+# CFOPs de interesse nos handlers, congelados no import com as duas
+# grafias (5401 e 5.401): o lookup testa o CFOP cru, dispensando o
+# replace('.', '') por linha que a normalização exigia
+def _both_cfop_forms(*cfops):
+    return frozenset(f for c in cfops for f in (c, c[0] + '.' + c[1:]))
+
+_IMOB_USO_CFOPS = _both_cfop_forms('1556','1407','1551','1406','2551','2556','2406','2407')
+_ST_CFOPS = _both_cfop_forms('5401','5403','5405','6401','6403')
+_ST_DIV_CFOPS = _both_cfop_forms('5401','5403','6403')
+_DIFAL_CFOPS = _both_cfop_forms('6107','6108')
+
+# Classificação de CFOP da DRE Fiscal, usada em máscaras isin na agregação
+_DRE_REVENUE_CFOPS = frozenset({'5101','5102','5403','5405','6101','6102','6403'})
+_DRE_OTHER_CFOPS = frozenset({'5949','6949','6910','5910'})
+_DRE_OTHER_PREFIXES = ('59','69')
+_DRE_COST_CFOPS = frozenset({'2102','2101','2403','2405','1102','1101','1403','1405'})
+_DRE_EXPENSE_CFOPS = frozenset({'2551','1551','1933'})
+
+# Códigos curtos de baixa cardinalidade (CFOP, CST, UF) repetem-se aos
+# milhões num SPED; internar colapsa as cópias num único objeto str
+_intern = sys.intern
+
+class _ParseContext:
+    """Estado mutável compartilhado pelos handlers de registro."""
+    __slots__ = (
+        'rec', 'append_row', 'file_name', 'master', 'flags', 'tipi',
+        'competence', 'row_prefix', 'note_prefix', 'ncm_map', 'desc_map',
+        'current_note', 'current_note_key', 'current_note_is_entry',
+        'current_note_has_c190', 'current_cte', 'e300_base',
+    )
+
+    def __init__(self, rec: SpedRecord, master: dict, flags: dict,
+                 ncm_map: Dict[str, str], desc_map: Dict[str, str],
+                 tipi: Dict[str, float]):
+        self.rec = rec
+        self.append_row = rec.append_row  # alias: poupa o lookup por linha
+        self.file_name = rec.file_name
+        self.master = master
+        self.flags = flags
+        self.tipi = tipi
+        # Competência corrente: rebatida apenas quando o 0000 é lido, para
+        # não derreferenciar master['competence'] a cada linha emitida
+        self.competence = master['competence']
+        self.rebuild_prefixes()
+        self.ncm_map = ncm_map
+        self.desc_map = desc_map
+        self.current_note: Optional[dict] = None
+        self.current_note_key: Optional[str] = None
+        self.current_note_is_entry = False
+        self.current_note_has_c190 = False
+        self.current_cte: Optional[dict] = None
+        self.e300_base: Optional[dict] = None
+
+    def rebuild_prefixes(self):
+        """Remonta os prefixos de linha imutáveis; só roda quando o 0000 muda.
+
+        Os dicts são compartilhados via {**prefix, ...} por todos os handlers,
+        então os campos repetidos (Arquivo, Competência, CNPJ, Razão Social)
+        não são remontados string a string por linha emitida.
+        """
+        master = self.master
+        self.row_prefix = {'Arquivo': self.file_name, 'Competência': self.competence}
+        self.note_prefix = {
+            'Arquivo': self.file_name, 'Competência': self.competence,
+            'CNPJ': master['company_cnpj'], 'Razão Social': master['company_name'],
+            'UF': master['company_cod_mun'],
+        }
+
+    def add_adjustment(self, reg_type: str, code: str, descr: str, value: float,
+                       note_id: Optional[str]=None):
+        self.append_row('adjustments', {
+            **self.row_prefix,
+            'Tipo Registro': reg_type, 'Código Ajuste': code, 'Descrição Ajuste': descr,
+            'Valor Ajuste': value, 'Nota': note_id or ''
+        })
+
+    def flush_missing_c190(self):
+        if self.current_note is not None and (not self.current_note_is_entry) and (not self.current_note_has_c190):
+            self.append_row('missing_c190', self.current_note)
+
+# ---- Handlers por registro (assinatura única: (parts, ctx))
+
+def _handle_0000(parts, ctx):
+    n = len(parts)
+    if n > 8:
+        master = ctx.master
+        dt_ini = parts[3] if n>3 else ''
+        dt_fin = parts[4] if n>4 else ''
+        d = dt_ini if (len(dt_ini)==8 and dt_ini.isdigit()) else (dt_fin if (len(dt_fin)==8 and dt_fin.isdigit()) else '')
+        if d:
+            master['competence'] = f"{d[2:4]}/{d[4:8]}"
+            ctx.competence = master['competence']
+        master['company_name'] = parts[6].strip() if n>6 else ''
+        master['company_cnpj'] = parts[7].strip() if n>7 else ''
+        master['company_ie'] = parts[9].strip() if n>9 else ''
+        master['company_cod_mun'] = parts[10].strip() if n>10 else ''
+        master['company_im'] = parts[11].strip() if n>11 else ''
+        master['company_profile'] = parts[14].strip() if n>14 else ''
+        master['company_status'] = parts[15].strip() if n>15 else ''
+        ctx.rebuild_prefixes()
+
+def _handle_0002(parts, ctx):
+    n = len(parts)
+    ctx.master['company_activity_type'] = parts[2].strip() if n>2 else ''
+
+def _handle_0005(parts, ctx):
+    n = len(parts)
+    master = ctx.master
+    if n>2: master['company_trade_name'] = parts[2].strip()
+    if n>3: master['company_phone'] = parts[3].strip()
+    if n>4: master['company_address'] = parts[4].strip()
+    if n>5: master['company_number'] = parts[5].strip()
+    if n>6: master['company_complement'] = parts[6].strip()
+    if n>7: master['company_district'] = parts[7].strip()
+    if n>10: master['company_email'] = parts[10].strip()
+
+def _handle_0015(parts, ctx):
+    n = len(parts)
+    if n>2 and parts[2].strip():
+        ctx.master['ie_substituted'].append(parts[2].strip())
+
+def _handle_0100(parts, ctx):
+    n = len(parts)
+    master = ctx.master
+    if n>2: master['accountant_name'] = parts[2].strip()
+    if n>3: master['accountant_cpf'] = parts[3].strip()
+    if n>4: master['accountant_crc'] = parts[4].strip()
+    if n>11: master['accountant_phone'] = parts[11].strip()
+    if n>13: master['accountant_email'] = parts[13].strip()
+
+def _handle_c100(parts, ctx):
+    n = len(parts)
+    ctx.flush_missing_c190()
+    ctx.current_note = None; ctx.current_note_key = None
+    ctx.current_note_is_entry = False; ctx.current_note_has_c190 = False
+    if n>2 and parts[2].strip() in {'0','1'}:
+        ctx.current_note_is_entry = (parts[2].strip()=='0')
+        try:
+            serie = parts[7].strip() if n>7 else ''
+            numero = parts[8].strip() if n>8 else ''
+            chave = parts[9].strip() if n>9 else ''
+            vl_doc = parse_float_br(parts[12]) if n>12 and parts[12].strip() else (parse_float_br(parts[11]) if n>11 and parts[11].strip() else 0.0)
+            bc_icms = parse_float_br(parts[21]) if n>21 and parts[21].strip() else (parse_float_br(parts[20]) if n>20 and parts[20].strip() else 0.0)
+            vl_icms = parse_float_br(parts[22]) if n>22 and parts[22].strip() else (parse_float_br(parts[21]) if n>21 and parts[21].strip() else 0.0)
+            vl_ipi  = parse_float_br(parts[25]) if n>25 and parts[25].strip() else (parse_float_br(parts[24]) if n>24 and parts[24].strip() else 0.0)
+            ctx.current_note = {
+                **ctx.note_prefix,
+                'Série da nota': serie, 'Número da nota': numero,
+                'Chave': chave, 'Data de emissão': parts[10].strip() if n>10 else '',
+                'Valor Total Nota': vl_doc, 'BC ICMS Nota': bc_icms, 'Valor ICMS Nota': vl_icms,
+                'Valor IPI Nota': vl_ipi, 'Tipo Nota': ('Entrada' if ctx.current_note_is_entry else 'Saída')
+            }
+            ctx.current_note_key = chave
+            if not ctx.current_note_is_entry: ctx.flags['has_c100_saida'] = True
+        except Exception:
+            ctx.current_note = None; ctx.current_note_key = None
+            ctx.current_note_is_entry = False; ctx.current_note_has_c190 = False
+
+def _handle_c170(parts, ctx):
+    n = len(parts)
+    if n < 25:
+        return
+    try:
+        num_item = parts[2].strip(); cod_item = parts[3].strip()
+        cfop = _intern(parts[11].strip()) if n>11 else ''
+        cst_icms = _intern(parts[10].strip()) if n>10 else ''
+        cst_ipi  = _intern(parts[20].strip()) if n>20 else ''
+        val_item = parse_float_br(parts[7]) if n>7 else 0.0
+        bc_icms_item = parse_float_br(parts[13]) if n>13 else 0.0
+        aliq_icms_item = parse_aliq_br(parts[14]) if n>14 else 0.0
+        vl_icms_item = parse_float_br(parts[15]) if n>15 else 0.0
+        aliq_ipi_item = parse_aliq_br(parts[23]) if n>23 else 0.0
+        vl_ipi_item   = parse_float_br(parts[24]) if n>24 else 0.0
+        ncm = ctx.ncm_map.get(cod_item, '')
+        descr = ctx.desc_map.get(cod_item, '')
+        item_rec = {
+            **ctx.current_note,
+            'Num. Item': num_item, 'Cód. Item': cod_item, 'Descrição do Produto': descr,
+            'CFOP': cfop, 'CST ICMS': cst_icms, 'CST IPI': cst_ipi,
+            'Valor Total Item': val_item, 'BC ICMS Item': bc_icms_item,
+            'Alíquota ICMS Item (%)': aliq_icms_item, 'Valor ICMS Item': vl_icms_item,
+            'Alíq. Efetiva (%)': 0.0, 'Alíquota IPI Item (%)': aliq_ipi_item,
+            'Valor IPI Item': vl_ipi_item, 'NCM Item': ncm
+        }
+        ctx.append_row('items', item_rec)
+        if ctx.current_note_is_entry:
+            ctx.append_row('entries', item_rec)
+            if cfop in _IMOB_USO_CFOPS:
+                ctx.append_row('imob_uso', {
+                    **item_rec,
+                    'Situação Crédito': ('❌ Crédito indevido sobre Uso/Consumo' if (vl_icms_item>0.001 or vl_ipi_item>0.001) else '✅ Sem crédito indevido')
+                })
+    except Exception:
+        pass
+
+def _handle_c190(parts, ctx):
+    n = len(parts)
+    if ctx.current_note_is_entry:
+        return
+    if not ctx.current_note_has_c190:
+        ctx.current_note_has_c190 = True
+    try:
+        cst_icms = _intern(parts[2].strip()) if n>2 else ''
+        cfop = _intern(parts[3].strip()) if n>3 else ''
+        aliq = parse_aliq_br(parts[4]) if n>4 else 0.0
+        vl_opr = parse_float_br(parts[5]) if n>5 else 0.0
+        bc_icms = parse_float_br(parts[6]) if n>6 else 0.0
+        vl_icms = parse_float_br(parts[7]) if n>7 else 0.0
+        vl_ipi  = parse_float_br(parts[11]) if n>11 else 0.0
+        ctx.append_row('outputs', {
+            **ctx.current_note,
+            'CST ICMS':cst_icms,'CFOP':cfop,'Alíquota ICMS':aliq,'Valor Operação':vl_opr,
+            'BC ICMS':bc_icms,'Valor ICMS':vl_icms,'Alíq. Efetiva (%)':0.0,'Valor IPI Nota':vl_ipi})
+        flags = ctx.flags
+        if cfop in _ST_CFOPS:
+            flags['has_st_cfop'] = True
+        if cfop in _ST_DIV_CFOPS:
+            flags['has_st_cfop_divergence'] = True
+        if cfop in _DIFAL_CFOPS:
+            flags['has_difal_cfop'] = True
+    except Exception:
+        pass
+
+def _handle_d100(parts, ctx):
+    n = len(parts)
+    ctx.current_cte = None
+    try:
+        serie = parts[7].strip() if n>7 else ''
+        numero = parts[9].strip() if n>9 else ''
+        chave  = parts[10].strip() if n>10 else ''
+        vl_total = parse_float_br(parts[15]) if n>15 else 0.0
+        bc_icms_cte = parse_float_br(parts[18]) if n>18 else 0.0
+        vl_icms_cte = parse_float_br(parts[20]) if n>20 else 0.0
+        ctx.current_cte = {
+            **ctx.row_prefix,
+            'Chave CT-e': chave, 'Série CT-e': serie, 'Número CT-e': numero,
+            'Data de emissão': parts[11].strip() if n>11 else '',
+            'Valor Total CT-e': vl_total, 'BC ICMS CT-e': bc_icms_cte, 'Valor ICMS CT-e': vl_icms_cte
+        }
+    except Exception:
+        ctx.current_cte = None
+
+def _handle_d190(parts, ctx):
+    n = len(parts)
+    try:
+        cst = _intern(parts[2].strip()) if n>2 else ''
+        cfop = _intern(parts[3].strip()) if n>3 else ''
+        aliq = parse_aliq_br(parts[4]) if n>4 else 0.0
+        vl_opr = parse_float_br(parts[5]) if n>5 else 0.0
+        bc_icms = parse_float_br(parts[6]) if n>6 else 0.0
+        vl_icms = parse_float_br(parts[7]) if n>7 else 0.0
+        eff = (vl_icms/vl_opr*100.0) if vl_opr>0 else 0.0
+        ctx.append_row('cte', {
+            **ctx.current_cte,
+            'CST CT-e':cst,'CFOP CT-e':cfop,'Alíquota ICMS CT-e':aliq,
+            'Valor Operação CT-e':vl_opr,'BC ICMS CT-e (D190)':bc_icms,
+            'Valor ICMS CT-e (D190)':vl_icms,'Alíq. Efetiva CT-e (%)':eff,
+            'Valor IPI CT-e':0.0,'NCM Item':'Não se Aplica','Descrição do Produto':'Serviço de Transporte'})
+    except Exception:
+        pass
+
+def _handle_c195(parts, ctx):
+    n = len(parts)
+    txt = parts[3].strip() if n>3 else ''
+    if txt:
+        ctx.append_row('adjustments', {
+            **ctx.row_prefix,
+            'Tipo Registro':'C195','Código Ajuste':'','Descrição Ajuste':txt,
+            'Valor Ajuste':0.0,'Nota': ctx.current_note_key or ''
+        })
+
+def _handle_c197(parts, ctx):
+    n = len(parts)
+    code = parts[2].strip() if n>2 else ''
+    descr = parts[3].strip() if n>3 else ''
+    adj_value = 0.0
+    # Interessa o último valor positivo: varrendo de trás para frente o
+    # primeiro achado já resolve, sem converter os campos anteriores
+    for it in reversed(parts[4:]):
+        v = parse_float_br(it)
+        if v>0:
+            adj_value = v
+            break
+    ctx.add_adjustment('C197', code, descr, adj_value, ctx.current_note_key)
+
+def _handle_e111(parts, ctx):
+    n = len(parts)
+    code = parts[2].strip() if n>2 else ''
+    descr = parts[3].strip() if n>3 else ''
+    value = parse_float_br(parts[4]) if n>4 else 0.0
+    ctx.add_adjustment('E111', code, descr, value)
+
+def _handle_e115(parts, ctx):
+    n = len(parts)
+    code = parts[2].strip() if n>2 else ''
+    value = parse_float_br(parts[3]) if n>3 else 0.0
+    descr = parts[4].strip() if n>4 else ''
+    ctx.add_adjustment('E115', code, descr, value)
+
+def _handle_e116(parts, ctx):
+    n = len(parts)
+    cod_or = parts[2].strip() if n>2 else ''
+    value = parse_float_br(parts[3]) if n>3 else 0.0
+    cod_rec = parts[5].strip() if n>5 else ''
+    txt = parts[9].strip() if n>9 else ''
+    descr = f"{cod_or} {cod_rec} {txt}".strip()
+    ctx.add_adjustment('E116', cod_rec or cod_or, descr, value)
+
+def _handle_e200(parts, ctx):
+    n = len(parts)
+    # Apenas salvamos presença e UF por simplicidade
+    if n>4:
+        ctx.append_row('st_blocks', {
+            **ctx.row_prefix,
+            'UF': _intern(parts[2].strip()), 'Data Início': parts[3].strip(), 'Data Fim': parts[4].strip()
+        })
+
+def _handle_e300(parts, ctx):
+    n = len(parts)
+    if n>4:
+        ctx.e300_base = {**ctx.row_prefix,
+                         'UF': _intern(parts[2].strip()), 'Data Início': parts[3].strip(), 'Data Fim': parts[4].strip()}
+
+def _handle_e316(parts, ctx):
+    n = len(parts)
+    if ctx.e300_base is None:
+        return
+    ctx.append_row('difal_blocks', {
+        **ctx.e300_base,
+        'Código Receita': parts[2].strip() if n>2 else '',
+        'Valor Recolhimento': parse_float_br(parts[3]) if n>3 else 0.0,
+        'Data Recolhimento': parts[4].strip() if n>4 else '',
+    })
+
+def _handle_g110(parts, ctx):
+    ctx.flags['has_block_g110'] = True
+
+# Dispatch montado uma vez no import: um dict.get por linha substitui a
+# cascata de comparações reg == '...' do loop antigo
+_SPED_HANDLERS = {
+    '0000': _handle_0000, '0002': _handle_0002, '0005': _handle_0005,
+    '0015': _handle_0015, '0100': _handle_0100,
+    'C100': _handle_c100,
+    'D100': _handle_d100,
+    'E111': _handle_e111, 'E115': _handle_e115, 'E116': _handle_e116,
+    'E200': _handle_e200, 'E300': _handle_e300, 'E316': _handle_e316,
+    'G110': _handle_g110,
+}
+
+# Registros filhos de C100/D100: despachados só quando a nota (ou CT-e)
+# corrente existe, poupando a chamada do handler para filhos órfãos
+_NOTE_HANDLERS = {
+    'C170': _handle_c170, 'C190': _handle_c190,
+    'C195': _handle_c195, 'C197': _handle_c197,
+}
+_CTE_HANDLERS = {'D190': _handle_d190}
+
+# Flags de presença disparadas por prefixo de bloco (qualquer E2xx/E3xx),
+# resolvidas por lookup em vez de cadeia de startswith no laço quente
+_BLOCK_FLAG_BY_PREFIX = {'E2': 'has_block_e200', 'E3': 'has_block_e300'}
+
+# maxsplit por registro = maior índice lido pelo handler + 1: o resto da
+# linha (campos que ninguém consome) fica num único str em vez de virar
+# dezenas de objetos por linha. C197 fica de fora porque varre os campos
+# finais em busca do valor do ajuste e precisa do split completo; o
+# default -1 equivale ao split sem limite.
+_REG_MAXSPLIT = {
+    b'0000': 16, b'0002': 3, b'0005': 11, b'0015': 3, b'0100': 14,
+    b'C100': 26, b'C170': 25, b'C190': 12, b'C195': 4,
+    b'D100': 21, b'D190': 8,
+    b'E111': 5, b'E115': 5, b'E116': 10,
+    b'E200': 5, b'E300': 5, b'E316': 5,
+    b'G110': 2,
+}
+
+def parse_sped_bytes(file_name: str, data: bytes, tipi: Dict[str, float]) -> SpedRecord:
     rec = SpedRecord(file_name)
+    if not isinstance(data, bytes):
+        data = bytes(data)  # aceita memoryview/bytearray vindos de upload
     enc = detect_encoding_from_bytes(data)
-    text = data.decode(enc, errors='ignore')
+    if data.startswith(b'\xef\xbb\xbf'):
+        # Sem isso, o BOM gruda no |0000| da primeira linha e o gate de
+        # prefixo em bytes descartaria o registro de abertura inteiro
+        data = data[3:]
+        if enc == 'utf-8-sig':
+            enc = 'utf-8'
+    # Itera o buffer linha a linha em vez de data.split(b'\n'): evita
+    # materializar a lista inteira de linhas (milhões de objetos bytes
+    # vivos ao mesmo tempo num SPED grande) antes de começar o parse
+    lines = io.BytesIO(data)
+    # Passada de catálogo: resolve os mapas do 0200 (cód. item -> NCM e
+    # descrição) antes da passada principal. O teste startswith descarta as
+    # demais linhas sem pagar decode nem split('|'), e garante que todo C170
+    # enxergue o catálogo completo independentemente da ordem dos blocos.
     ncm_map: Dict[str, str] = {}
     desc_map: Dict[str, str] = {}
-    current_note: Optional[dict] = None
-    current_note_key: Optional[str] = None
-    current_note_is_entry = False
-    current_note_has_c190 = False
-    current_cte: Optional[dict] = None
+    for raw_line in lines:
+        raw = raw_line.strip()
+        if not raw.startswith(b'|0200|'):
+            continue
+        parts = raw.decode(enc, errors='ignore').split('|', 9)
+        n = len(parts)
+        cod_item = parts[2].strip() if n>2 else ''
+        descr_item = parts[3].strip() if n>3 else ''
+        ncm = parts[8].strip() if n>8 else ''
+        if cod_item:
+            if ncm: ncm_map[cod_item] = ncm
+            if descr_item: desc_map[cod_item] = descr_item
     master = {
         'competence':'','company_name':'','company_cnpj':'','company_ie':'','company_cod_mun':'',
         'company_im':'','company_profile':'','company_status':'','company_activity_type':'',
@@ -266,318 +942,148 @@ def parse_sped_bytes(file_name: str, data: bytes, xml_map: Dict[str, Dict[str, a
         'accountant_name':'','accountant_cpf':'','accountant_crc':'','accountant_phone':'','accountant_email':''
     }
     flags = {'has_c100_saida':False,'has_st_cfop':False,'has_st_cfop_divergence':False,'has_block_e200':False,'has_difal_cfop':False,'has_block_e300':False,'has_block_g110':False}
+    ctx = _ParseContext(rec, master, flags, ncm_map, desc_map, tipi)
+    handlers_get = _SPED_HANDLERS.get
+    note_handlers_get = _NOTE_HANDLERS.get
+    cte_handlers_get = _CTE_HANDLERS.get
+    maxsplit_get = _REG_MAXSPLIT.get
 
-    def add_adjustment(reg_type: str, code: str, descr: str, value: float, note_id: Optional[str]=None):
-        rec.adjustments.append({
-            'Arquivo': file_name, 'Competência': master['competence'],
-            'Tipo Registro': reg_type, 'Código Ajuste': code, 'Descrição Ajuste': descr,
-            'Valor Ajuste': value, 'Nota': note_id or ''
-        })
-
-    for raw_line in text.splitlines():
-        line = raw_line.strip()
-        if not line or '|' not in line: 
+    lines.seek(0)
+    for raw_line in lines:
+        raw = raw_line.strip()
+        if not raw.startswith(_HANDLED_PREFIXES_B):
             continue
-        parts = line.split('|')
+        parts = raw.decode(enc, errors='ignore').split('|', maxsplit_get(raw[1:5], -1))
         reg = parts[1] if len(parts)>1 else ''
-        # ---- Mestres
-        if reg == '0000':
-            if len(parts) > 8:
-                dt_ini = parts[3] if len(parts)>3 else ''
-                dt_fin = parts[4] if len(parts)>4 else ''
-                d = dt_ini if (len(dt_ini)==8 and dt_ini.isdigit()) else (dt_fin if (len(dt_fin)==8 and dt_fin.isdigit()) else '')
-                if d:
-                    master['competence'] = f"{d[2:4]}/{d[4:8]}"
-                master['company_name'] = parts[6].strip() if len(parts)>6 else ''
-                master['company_cnpj'] = parts[7].strip() if len(parts)>7 else ''
-                master['company_ie'] = parts[9].strip() if len(parts)>9 else ''
-                master['company_cod_mun'] = parts[10].strip() if len(parts)>10 else ''
-                master['company_im'] = parts[11].strip() if len(parts)>11 else ''
-                master['company_profile'] = parts[14].strip() if len(parts)>14 else ''
-                master['company_status'] = parts[15].strip() if len(parts)>15 else ''
-        elif reg == '0002':
-            master['company_activity_type'] = parts[2].strip() if len(parts)>2 else ''
-        elif reg == '0005':
-            if len(parts)>2: master['company_trade_name'] = parts[2].strip()
-            if len(parts)>3: master['company_phone'] = parts[3].strip()
-            if len(parts)>4: master['company_address'] = parts[4].strip()
-            if len(parts)>5: master['company_number'] = parts[5].strip()
-            if len(parts)>6: master['company_complement'] = parts[6].strip()
-            if len(parts)>7: master['company_district'] = parts[7].strip()
-            if len(parts)>10: master['company_email'] = parts[10].strip()
-        elif reg == '0015':
-            if len(parts)>2 and parts[2].strip():
-                master['ie_substituted'].append(parts[2].strip())
-        elif reg == '0100':
-            if len(parts)>2: master['accountant_name'] = parts[2].strip()
-            if len(parts)>3: master['accountant_cpf'] = parts[3].strip()
-            if len(parts)>4: master['accountant_crc'] = parts[4].strip()
-            if len(parts)>11: master['accountant_phone'] = parts[11].strip()
-            if len(parts)>13: master['accountant_email'] = parts[13].strip()
-
-        # ---- 0200
-        if reg == '0200':
-            cod_item = parts[2].strip() if len(parts)>2 else ''
-            descr_item = parts[3].strip() if len(parts)>3 else ''
-            ncm = parts[8].strip() if len(parts)>8 else ''
-            if cod_item:
-                if ncm: ncm_map[cod_item] = ncm
-                if descr_item: desc_map[cod_item] = descr_item
-
-        # ---- C100
-        if reg == 'C100':
-            if current_note is not None and (not current_note_is_entry) and (not current_note_has_c190):
-                rec.missing_c190.append(current_note.copy())
-            current_note = None; current_note_key = None; current_note_is_entry = False; current_note_has_c190 = False
-            if len(parts)>2 and parts[2].strip() in {'0','1'}:
-                current_note_is_entry = (parts[2].strip()=='0')
-                try:
-                    serie = parts[7].strip() if len(parts)>7 else ''
-                    numero = parts[8].strip() if len(parts)>8 else ''
-                    chave = parts[9].strip() if len(parts)>9 else ''
-                    vl_doc = parse_float_br(parts[12]) if len(parts)>12 and parts[12].strip() else (parse_float_br(parts[11]) if len(parts)>11 and parts[11].strip() else 0.0)
-                    bc_icms = parse_float_br(parts[21]) if len(parts)>21 and parts[21].strip() else (parse_float_br(parts[20]) if len(parts)>20 and parts[20].strip() else 0.0)
-                    vl_icms = parse_float_br(parts[22]) if len(parts)>22 and parts[22].strip() else (parse_float_br(parts[21]) if len(parts)>21 and parts[21].strip() else 0.0)
-                    vl_ipi  = parse_float_br(parts[25]) if len(parts)>25 and parts[25].strip() else (parse_float_br(parts[24]) if len(parts)>24 and parts[24].strip() else 0.0)
-                    current_note = {
-                        'Arquivo': file_name, 'Competência': master['competence'],
-                        'CNPJ': master['company_cnpj'], 'Razão Social': master['company_name'],
-                        'UF': master['company_cod_mun'], 'Série da nota': serie, 'Número da nota': numero,
-                        'Chave': chave, 'Data de emissão': parts[10].strip() if len(parts)>10 else '',
-                        'Valor Total Nota': vl_doc, 'BC ICMS Nota': bc_icms, 'Valor ICMS Nota': vl_icms,
-                        'Valor IPI Nota': vl_ipi, 'Tipo Nota': ('Entrada' if current_note_is_entry else 'Saída')
-                    }
-                    current_note_key = chave
-                    if not current_note_is_entry: flags['has_c100_saida'] = True
-                except Exception:
-                    current_note = None; current_note_key=None; current_note_is_entry=False; current_note_has_c190=False
-
-        # ---- C170 (itens)
-        if reg == 'C170' and current_note is not None:
-            if len(parts) < 25: 
-                continue
-            try:
-                num_item = parts[2].strip(); cod_item = parts[3].strip()
-                cfop = parts[11].strip() if len(parts)>11 else ''
-                cst_icms = parts[10].strip() if len(parts)>10 else ''
-                cst_ipi  = parts[20].strip() if len(parts)>20 else ''
-                val_item = parse_float_br(parts[7]) if len(parts)>7 else 0.0
-                bc_icms_item = parse_float_br(parts[13]) if len(parts)>13 else 0.0
-                aliq_icms_item = parse_float_br(parts[14]) if len(parts)>14 else 0.0
-                vl_icms_item = parse_float_br(parts[15]) if len(parts)>15 else 0.0
-                aliq_ipi_item = parse_float_br(parts[23]) if len(parts)>23 else 0.0
-                vl_ipi_item   = parse_float_br(parts[24]) if len(parts)>24 else 0.0
-                eff_aliq = (vl_icms_item/val_item*100.0) if val_item>0 else 0.0
-                ncm = ncm_map.get(cod_item, '')
-                descr = desc_map.get(cod_item, '')
-                ipi_status = ''
-                if aliq_ipi_item == 0.0:
-                    ipi_status = 'Conforme'
-                elif not tipi:
-                    ipi_status = 'TIPI não carregada'
-                elif not ncm:
-                    ipi_status = 'NCM não encontrado'
-                elif ncm not in tipi:
-                    ipi_status = 'NCM não encontrado na TIPI'
-                else:
-                    exp = tipi[ncm]
-                    ipi_status = 'Conforme' if abs(aliq_ipi_item-exp) < 0.001 else f'Divergente (TIPI: {exp:.2f}%)'
-                item_rec = current_note.copy()
-                item_rec.update({
-                    'Num. Item': num_item, 'Cód. Item': cod_item, 'Descrição do Produto': descr,
-                    'CFOP': cfop, 'CST ICMS': cst_icms, 'CST IPI': cst_ipi,
-                    'Valor Total Item': val_item, 'BC ICMS Item': bc_icms_item,
-                    'Alíquota ICMS Item (%)': aliq_icms_item, 'Valor ICMS Item': vl_icms_item,
-                    'Alíq. Efetiva (%)': eff_aliq, 'Alíquota IPI Item (%)': aliq_ipi_item,
-                    'Valor IPI Item': vl_ipi_item, 'NCM Item': ncm, 'Conformidade IPI x TIPI': ipi_status
-                })
-                rec.items.append(item_rec)
-                if current_note_is_entry:
-                    rec.entries.append(item_rec)
-                    if cfop.replace('.','') in {'1556','1407','1551','1406','2551','2556','2406','2407'}:
-                        uso = item_rec.copy()
-                        uso['Situação Crédito'] = ('❌ Crédito indevido sobre Uso/Consumo' if (vl_icms_item>0.001 or vl_ipi_item>0.001) else '✅ Sem crédito indevido')
-                        rec.imob_uso.append(uso)
-            except Exception:
-                pass
+        handler = handlers_get(reg)
+        if handler is None:
+            # Filhos dependentes de contexto: só valem com a nota/CT-e aberta
+            if ctx.current_note is not None:
+                handler = note_handlers_get(reg)
+            if handler is None and ctx.current_cte is not None:
+                handler = cte_handlers_get(reg)
+        if handler is not None:
+            handler(parts, ctx)
+        # ---- Flags de presença por prefixo (E2xx/E3xx), fora do dispatch exato
+        fkey = _BLOCK_FLAG_BY_PREFIX.get(reg[:2])
+        if fkey is not None:
+            flags[fkey] = True
 
-        # ---- C190 (saídas)
-        if reg == 'C190' and current_note is not None and (not current_note_is_entry):
-            current_note_has_c190 = True
-            try:
-                cst_icms = parts[2].strip() if len(parts)>2 else ''
-                cfop = parts[3].strip() if len(parts)>3 else ''
-                aliq = parse_float_br(parts[4]) if len(parts)>4 else 0.0
-                vl_opr = parse_float_br(parts[5]) if len(parts)>5 else 0.0
-                bc_icms = parse_float_br(parts[6]) if len(parts)>6 else 0.0
-                vl_icms = parse_float_br(parts[7]) if len(parts)>7 else 0.0
-                vl_ipi  = parse_float_br(parts[11]) if len(parts)>11 else 0.0
-                eff = (vl_icms/bc_icms*100.0) if bc_icms>0 else 0.0
-                out = current_note.copy()
-                out.update({'CST ICMS':cst_icms,'CFOP':cfop,'Alíquota ICMS':aliq,'Valor Operação':vl_opr,
-                            'BC ICMS':bc_icms,'Valor ICMS':vl_icms,'Alíq. Efetiva (%)':eff,'Valor IPI Nota':vl_ipi})
-                rec.outputs.append(out)
-                if cfop.replace('.','') in {'5401','5403','5405','6401','6403'}:
-                    flags['has_st_cfop'] = True
-                if cfop.replace('.','') in {'5401','5403','6403'}:
-                    flags['has_st_cfop_divergence'] = True
-                if cfop.replace('.','') in {'6107','6108'}:
-                    flags['has_difal_cfop'] = True
-            except Exception:
-                pass
-
-        # ---- D100/D190 (CT-e)
-        if reg == 'D100':
-            current_cte = None
-            try:
-                serie = parts[7].strip() if len(parts)>7 else ''
-                numero = parts[9].strip() if len(parts)>9 else ''
-                chave  = parts[10].strip() if len(parts)>10 else ''
-                vl_total = parse_float_br(parts[15]) if len(parts)>15 else 0.0
-                bc_icms_cte = parse_float_br(parts[18]) if len(parts)>18 else 0.0
-                vl_icms_cte = parse_float_br(parts[20]) if len(parts)>20 else 0.0
-                current_cte = {
-                    'Arquivo': file_name, 'Competência': master['competence'],
-                    'Chave CT-e': chave, 'Série CT-e': serie, 'Número CT-e': numero,
-                    'Data de emissão': parts[11].strip() if len(parts)>11 else '',
-                    'Valor Total CT-e': vl_total, 'BC ICMS CT-e': bc_icms_cte, 'Valor ICMS CT-e': vl_icms_cte
-                }
-            except Exception:
-                current_cte = None
-        if reg == 'D190' and current_cte is not None:
-            try:
-                cst = parts[2].strip() if len(parts)>2 else ''
-                cfop = parts[3].strip() if len(parts)>3 else ''
-                aliq = parse_float_br(parts[4]) if len(parts)>4 else 0.0
-                vl_opr = parse_float_br(parts[5]) if len(parts)>5 else 0.0
-                bc_icms = parse_float_br(parts[6]) if len(parts)>6 else 0.0
-                vl_icms = parse_float_br(parts[7]) if len(parts)>7 else 0.0
-                eff = (vl_icms/vl_opr*100.0) if vl_opr>0 else 0.0
-                row = current_cte.copy()
-                row.update({'CST CT-e':cst,'CFOP CT-e':cfop,'Alíquota ICMS CT-e':aliq,
-                            'Valor Operação CT-e':vl_opr,'BC ICMS CT-e (D190)':bc_icms,
-                            'Valor ICMS CT-e (D190)':vl_icms,'Alíq. Efetiva CT-e (%)':eff,
-                            'Valor IPI CT-e':0.0,'NCM Item':'Não se Aplica','Descrição do Produto':'Serviço de Transporte'})
-                rec.cte.append(row)
-            except Exception:
-                pass
-
-        # ---- Ajustes por documento/periodo
-        if reg == 'C195' and current_note is not None:
-            txt = parts[3].strip() if len(parts)>3 else ''
-            if txt:
-                rec.adjustments.append({
-                    'Arquivo': file_name, 'Competência': master['competence'],
-                    'Tipo Registro':'C195','Código Ajuste':'','Descrição Ajuste':txt,
-                    'Valor Ajuste':0.0,'Nota': current_note_key or ''
-                })
-        if reg == 'C197' and current_note is not None:
-            code = parts[2].strip() if len(parts)>2 else ''
-            descr = parts[3].strip() if len(parts)>3 else ''
-            adj_value = 0.0
-            for it in parts[4:]:
-                v = parse_float_br(it)
-                if v>0: adj_value = v
-            add_adjustment('C197', code, descr, adj_value, current_note_key)
-        if reg == 'E111':
-            code = parts[2].strip() if len(parts)>2 else ''
-            descr = parts[3].strip() if len(parts)>3 else ''
-            value = parse_float_br(parts[4]) if len(parts)>4 else 0.0
-            add_adjustment('E111', code, descr, value)
-        if reg == 'E115':
-            code = parts[2].strip() if len(parts)>2 else ''
-            value = parse_float_br(parts[3]) if len(parts)>3 else 0.0
-            descr = parts[4].strip() if len(parts)>4 else ''
-            add_adjustment('E115', code, descr, value)
-        if reg == 'E116':
-            cod_or = parts[2].strip() if len(parts)>2 else ''
-            value = parse_float_br(parts[3]) if len(parts)>3 else 0.0
-            cod_rec = parts[5].strip() if len(parts)>5 else ''
-            txt = parts[9].strip() if len(parts)>9 else ''
-            descr = f"{cod_or} {cod_rec} {txt}".strip()
-            add_adjustment('E116', cod_rec or cod_or, descr, value)
-
-        # ---- Flags de blocos
-        if reg.startswith('E2'): flags['has_block_e200'] = True
-        if reg.startswith('E3'): flags['has_block_e300'] = True
-        if reg == 'G110': flags['has_block_g110'] = True
-
-        # ---- E200/E210
-        # Apenas salvamos presença e UF por simplicidade
-        if reg == 'E200' and len(parts)>4:
-            rec.st_blocks.append({
-                'Arquivo': file_name, 'Competência': master['competence'],
-                'UF': parts[2].strip(), 'Data Início': parts[3].strip(), 'Data Fim': parts[4].strip()
-            })
-        # ---- E300/E310/E316 (resumo simplificado)
-        if reg == 'E300' and len(parts)>4:
-            base = {'Arquivo': file_name, 'Competência': master['competence'],
-                    'UF': parts[2].strip(), 'Data Início': parts[3].strip(), 'Data Fim': parts[4].strip()}
-        if reg == 'E316' and 'base' in locals():
-            row = dict(base)
-            row['Código Receita'] = parts[2].strip() if len(parts)>2 else ''
-            row['Valor Recolhimento'] = parse_float_br(parts[3]) if len(parts)>3 else 0.0
-            row['Data Recolhimento'] = parts[4].strip() if len(parts)>4 else ''
-            rec.difal_blocks.append(row)
-
-        # fim loop linhas
-
-    if current_note is not None and (not current_note_is_entry) and (not current_note_has_c190):
-        rec.missing_c190.append(current_note.copy())
+    ctx.flush_missing_c190()
 
     rec.master_data = master.copy()
     rec.block_flags = flags.copy()
 
-    # Anexa cruzamento com mapa XML (se houver)
-    if xml_map:
-        for item in rec.entries:
-            key = item.get('Chave')
-            if key and key in xml_map:
-                x = xml_map[key]
-                item['Valor ICMS XML'] = x.get('Valor ICMS XML', 0.0)
-                item['Valor IPI XML'] = x.get('Valor IPI XML', 0.0)
-                item['Valor Produtos XML'] = x.get('Valor Produtos XML', 0.0)
-        for out in rec.outputs:
-            key = out.get('Chave')
-            if key and key in xml_map:
-                x = xml_map[key]
-                out['Valor ICMS XML'] = x.get('Valor ICMS XML', 0.0)
-                out['Valor IPI XML'] = x.get('Valor IPI XML', 0.0)
-                out['Valor Produtos XML'] = x.get('Valor Produtos XML', 0.0)
+    # Alíquota efetiva e conformidade IPI x TIPI em passadas vetorizadas
+    compute_effective_rates(rec)
+    for table in ('items', 'entries', 'imob_uso'):
+        compute_ipi_conformity(rec.tables[table], tipi)
 
     return rec
 
+def parse_sped_many(named_blobs: List[tuple], tipi: Dict[str, float],
+                    workers: Optional[int] = None) -> List[tuple]:
+    """Parseia vários SPEDs, um processo por arquivo quando há mais de um.
+
+    Recebe pares (nome, bytes) e devolve triplas (nome, SpedRecord ou None,
+    exceção ou None) na ordem de entrada. Cada arquivo gera um SpedRecord
+    independente, então o trabalho distribui quase linearmente pelos núcleos;
+    com um único arquivo o parse é serial para não pagar o custo do pool.
+    """
+    named_blobs = [(name, bytes(blob)) for name, blob in named_blobs]
+    results: List[tuple] = []
+    if len(named_blobs) <= 1:
+        for name, blob in named_blobs:
+            try:
+                results.append((name, parse_sped_bytes(name, blob, tipi), None))
+            except Exception as exc:
+                results.append((name, None, exc))
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(name, pool.submit(parse_sped_bytes, name, blob, tipi))
+                   for name, blob in named_blobs]
+        for name, fut in futures:
+            try:
+                results.append((name, fut.result(), None))
+            except Exception as exc:
+                results.append((name, None, exc))
+    return results
+
 # -------------------------
 # Agregações
 # -------------------------
 
-def aggregate_records(records: List[SpedRecord]) -> Dict[str, pd.DataFrame]:
-    df_entries = pd.DataFrame([r for rec in records for r in rec.entries])
-    df_outputs = pd.DataFrame([r for rec in records for r in rec.outputs])
-    df_items   = pd.DataFrame([r for rec in records for r in rec.items])
-    df_imob    = pd.DataFrame([r for rec in records for r in rec.imob_uso])
-    df_cte     = pd.DataFrame([r for rec in records for r in rec.cte])
-    df_adj     = pd.DataFrame([r for rec in records for r in rec.adjustments])
-    df_st      = pd.DataFrame([r for rec in records for r in rec.st_blocks])
-    df_difal   = pd.DataFrame([r for rec in records for r in rec.difal_blocks])
-    df_ipi     = pd.DataFrame([r for rec in records for r in rec.ipi_blocks])
-    df_missing = pd.DataFrame([r for rec in records for r in rec.missing_c190])
+def table_to_frame(records: List[SpedRecord], table: str) -> pd.DataFrame:
+    """Monta o DataFrame de uma tabela direto das colunas acumuladas."""
+    frames = [rec.table_frame(table) for rec in records if rec.row_counts[table]]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+# Colunas de valoração trazidas do XML no cruzamento por Chave
+_XML_VALUE_COLUMNS = ('Valor ICMS XML', 'Valor IPI XML', 'Valor Produtos XML')
+
+def attach_xml_values(df: pd.DataFrame, df_xml: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """Cruza as notas com o índice de XMLs via merge vetorizado em 'Chave'."""
+    if df_xml is None or df.empty or 'Chave' not in df.columns:
+        return df
+    return df.merge(df_xml, on='Chave', how='left')
+
+def xml_map_frame(xml_map: Optional[Dict[str, Dict[str, any]]]) -> Optional[pd.DataFrame]:
+    """Converte o índice {chave: dados} em DataFrame pronto para o merge."""
+    if not xml_map:
+        return None
+    df_xml = pd.DataFrame.from_dict(xml_map, orient='index')
+    keep = [c for c in _XML_VALUE_COLUMNS if c in df_xml.columns]
+    if not keep:
+        return None
+    return df_xml[keep].rename_axis('Chave').reset_index()
+
+def aggregate_records(records: List[SpedRecord],
+                      xml_map: Optional[Dict[str, Dict[str, any]]] = None) -> Dict[str, pd.DataFrame]:
+    df_xml = xml_map_frame(xml_map)
+    df_entries = attach_xml_values(table_to_frame(records, 'entries'), df_xml)
+    df_outputs = attach_xml_values(table_to_frame(records, 'outputs'), df_xml)
+    df_items   = attach_xml_values(table_to_frame(records, 'items'), df_xml)
+    df_imob    = table_to_frame(records, 'imob_uso')
+    df_cte     = table_to_frame(records, 'cte')
+    df_adj     = table_to_frame(records, 'adjustments')
+    df_st      = table_to_frame(records, 'st_blocks')
+    df_difal   = table_to_frame(records, 'difal_blocks')
+    df_ipi     = table_to_frame(records, 'ipi_blocks')
+    df_missing = table_to_frame(records, 'missing_c190')
     df_master  = pd.DataFrame([rec.master_data for rec in records])
     df_flags   = pd.DataFrame([rec.block_flags for rec in records])
 
     sheets: Dict[str, pd.DataFrame] = {}
 
+    # As colunas de valores já nascem float64 dos buffers array('d'); os
+    # fillna cobrem apenas NaN de concat entre arquivos com colunas
+    # diferentes, sem repassar pd.to_numeric célula a célula
     if not df_items.empty:
         for c in ['Valor Total Item','BC ICMS Item','Valor ICMS Item','Valor IPI Item']:
             if c in df_items.columns:
-                df_items[c] = pd.to_numeric(df_items[c], errors='coerce').fillna(0.0)
+                df_items[c] = df_items[c].fillna(0.0)
+        # Percentuais são limitados (0-100) e seguros em float32, metade dos
+        # bytes movidos; os valores monetários permanecem float64 para não
+        # perder centavos nas somas agregadas
+        for c in ('Alíquota ICMS Item (%)', 'Alíq. Efetiva (%)', 'Alíquota IPI Item (%)'):
+            if c in df_items.columns:
+                df_items[c] = df_items[c].fillna(0.0).astype(np.float32)
+        # Chaves de agrupamento viram Categorical: o groupby hasheia códigos
+        # inteiros em vez de strings e o frame detalhado encolhe na memória
+        for c in ('Tipo Nota','CNPJ','Razão Social','CFOP','CST ICMS','NCM Item','UF','Descrição do Produto'):
+            if c in df_items.columns:
+                df_items[c] = df_items[c].astype('category')
         sheets['Detalhes Itens'] = df_items
 
         # Resumo Itens por NCM-CFOP
         grp = [c for c in ['Tipo Nota','Competência','CNPJ','Razão Social','NCM Item','CFOP'] if c in df_items.columns]
         if grp:
             agg_cols = {c:'sum' for c in ['Valor Total Item','BC ICMS Item','Valor ICMS Item','Valor IPI Item'] if c in df_items.columns}
-            df_sum = df_items.groupby(grp).agg(agg_cols).reset_index().rename(columns={
+            df_sum = df_items.groupby(grp, observed=True).agg(agg_cols).reset_index().rename(columns={
                 'Valor Total Item':'Valor Contábil','BC ICMS Item':'BC ICMS','Valor ICMS Item':'ICMS','Valor IPI Item':'IPI'
             })
             sheets['Resumo Itens por NCM-CFOP'] = df_sum
@@ -586,103 +1092,121 @@ def aggregate_records(records: List[SpedRecord]) -> Dict[str, pd.DataFrame]:
         sheets['Detalhes Entradas'] = df_entries
         for c in ['Valor Total Item','BC ICMS Item','Valor ICMS Item','Valor IPI Item']:
             if c in df_entries.columns:
-                df_entries[c] = pd.to_numeric(df_entries[c], errors='coerce').fillna(0.0)
-        grp = [c for c in ['Competência','CNPJ','Razão Social','CFOP'] if c in df_entries.columns]
-        if grp:
-            df_cfop = df_entries.groupby(grp).agg({
-                'Valor Total Item':'sum','BC ICMS Item':'sum','Valor ICMS Item':'sum','Valor IPI Item':'sum'
-            }).reset_index().rename(columns={
-                'Valor Total Item':'Valor Contábil','BC ICMS Item':'BC ICMS','Valor ICMS Item':'ICMS','Valor IPI Item':'IPI'
-            })
-            sheets['Resumo Entradas por CFOP'] = df_cfop
+                df_entries[c] = df_entries[c].fillna(0.0)
+        # O resumo de entradas por CFOP é derivado do resumo fino por
+        # NCM-CFOP (soma de somas), poupando um groupby sobre o frame cheio
+        df_fine = sheets.get('Resumo Itens por NCM-CFOP')
+        if df_fine is not None and 'Tipo Nota' in df_fine.columns:
+            sub = df_fine[df_fine['Tipo Nota'] == 'Entrada']
+            grp = [c for c in ['Competência','CNPJ','Razão Social','CFOP'] if c in sub.columns]
+            if grp and not sub.empty:
+                agg_cols = {c:'sum' for c in ['Valor Contábil','BC ICMS','ICMS','IPI'] if c in sub.columns}
+                sheets['Resumo Entradas por CFOP'] = sub.groupby(grp, observed=True).agg(agg_cols).reset_index()
+        else:
+            grp = [c for c in ['Competência','CNPJ','Razão Social','CFOP'] if c in df_entries.columns]
+            if grp:
+                df_cfop = df_entries.groupby(grp, observed=True).agg({
+                    'Valor Total Item':'sum','BC ICMS Item':'sum','Valor ICMS Item':'sum','Valor IPI Item':'sum'
+                }).reset_index().rename(columns={
+                    'Valor Total Item':'Valor Contábil','BC ICMS Item':'BC ICMS','Valor ICMS Item':'ICMS','Valor IPI Item':'IPI'
+                })
+                sheets['Resumo Entradas por CFOP'] = df_cfop
 
     if not df_outputs.empty:
         sheets['Detalhes Saídas'] = df_outputs
         for c in ['Valor Total Nota','BC ICMS','Valor ICMS','Valor IPI Nota']:
             if c in df_outputs.columns:
-                df_outputs[c] = pd.to_numeric(df_outputs[c], errors='coerce').fillna(0.0)
+                df_outputs[c] = df_outputs[c].fillna(0.0)
+        for c in ('Competência','CNPJ','Razão Social','CFOP','CST ICMS'):
+            if c in df_outputs.columns:
+                df_outputs[c] = df_outputs[c].astype('category')
         grp = [c for c in ['Competência','CNPJ','Razão Social','CFOP','CST ICMS'] if c in df_outputs.columns]
         if grp:
-            df_out = df_outputs.groupby(grp).agg({
+            df_out = df_outputs.groupby(grp, observed=True).agg({
                 'Valor Total Nota':'sum','BC ICMS':'sum','Valor ICMS':'sum','Valor IPI Nota':'sum'
             }).reset_index().rename(columns={
                 'Valor Total Nota':'Valor Contábil','BC ICMS':'BC ICMS','Valor ICMS':'ICMS','Valor IPI Nota':'IPI'
             })
             sheets['Resumo Saídas por CFOP-CST'] = df_out
 
-    if not df_imob.empty:
-        sheets['Entradas Imob_UsoConsumo'] = df_imob
-    if not df_cte.empty:
-        sheets['Detalhes CT-e'] = df_cte
-    if not df_adj.empty:
-        sheets['Ajustes'] = df_adj
-    if not df_st.empty:
-        sheets['Resumo E200_ICMS_ST'] = df_st
-    if not df_difal.empty:
-        sheets['Resumo E300_DIFAL'] = df_difal
-    if not df_ipi.empty:
-        sheets['Resumo E500_IPI'] = df_ipi
-    if not df_missing.empty:
-        sheets['Notas Saída sem C190'] = df_missing
-    if not df_master.empty:
-        sheets['Dados Mestres'] = df_master
-    if not df_flags.empty:
-        sheets['Presença Blocos'] = df_flags
+    # Abas opcionais, dirigidas por tabela: entram só quando têm linhas
+    sheets.update({name: df for name, df in (
+        ('Entradas Imob_UsoConsumo', df_imob),
+        ('Detalhes CT-e', df_cte),
+        ('Ajustes', df_adj),
+        ('Resumo E200_ICMS_ST', df_st),
+        ('Resumo E300_DIFAL', df_difal),
+        ('Resumo E500_IPI', df_ipi),
+        ('Notas Saída sem C190', df_missing),
+        ('Dados Mestres', df_master),
+        ('Presença Blocos', df_flags),
+    ) if not df.empty})
 
     # DRE Fiscal (simplificada)
     dre_list: List[pd.DataFrame] = []
-    def _clean_cfop(x: str) -> str:
-        return str(x or '').replace('.','')
-    revenue_cfops = {'5101','5102','5403','5405','6101','6102','6403'}
-    other_explicit = {'5949','6949','6910','5910'}
-    other_prefix = ('59','69')
-    cost_cfops = {'2102','2101','2403','2405','1102','1101','1403','1405'}
-    expense_cfops = {'2551','1551','1933'}
-
-    def _build_category(df: pd.DataFrame, name: str, test_fn) -> Optional[pd.DataFrame]:
-        if df.empty: return None
-        m = df['CFOP'].apply(lambda c: test_fn(_clean_cfop(c)))
-        sub = df.loc[m].copy()
-        if sub.empty: return None
-        for c in ['Valor Contábil','ICMS','IPI']:
-            if c in sub.columns: sub[c] = pd.to_numeric(sub[c], errors='coerce').fillna(0.0)
-        gcols = [c for c in ['Competência','CNPJ','Razão Social'] if c in sub.columns]
-        if not gcols: gcols = ['Competência']
-        grouped = sub.groupby(gcols).agg({'Valor Contábil':'sum','ICMS':'sum','IPI':'sum'}).reset_index()
-        grouped['Categoria'] = name
-        grouped['Total Impostos'] = grouped['ICMS'] + grouped['IPI']
-        return grouped
+    dre_order = ['Receita','Outras Saídas','Custos','Despesas']
+
+    def _dre_rows(df: pd.DataFrame, masks, names) -> Optional[pd.DataFrame]:
+        # Rotula cada linha com sua categoria via np.select e devolve só as
+        # classificadas: o frame é varrido uma única vez, não uma vez por
+        # categoria, e o groupby acontece depois, já sobre o conjunto unido
+        cat = np.select(masks, names, default='')
+        keep = cat != ''
+        if not keep.any(): return None
+        cols = [c for c in ('Competência','CNPJ','Razão Social','Valor Contábil','ICMS','IPI') if c in df.columns]
+        sub = df.loc[keep, cols].copy()
+        sub['Categoria'] = cat[keep]
+        return sub
 
     if not df_outputs.empty:
         df_out = df_outputs.copy()
         if 'Valor Contábil' not in df_out.columns:
-            df_out['Valor Contábil'] = pd.to_numeric(df_out.get('Valor Total Nota', 0), errors='coerce').fillna(0.0)
+            df_out['Valor Contábil'] = df_out['Valor Total Nota'].fillna(0.0) if 'Valor Total Nota' in df_out.columns else 0.0
         if 'ICMS' not in df_out.columns:
-            df_out['ICMS'] = pd.to_numeric(df_out.get('Valor ICMS', 0), errors='coerce').fillna(0.0)
+            df_out['ICMS'] = df_out['Valor ICMS'].fillna(0.0) if 'Valor ICMS' in df_out.columns else 0.0
         if 'IPI' not in df_out.columns:
-            df_out['IPI'] = pd.to_numeric(df_out.get('Valor IPI Nota', 0), errors='coerce').fillna(0.0)
-        dre_rev = _build_category(df_out, 'Receita', lambda c: c in revenue_cfops)
-        if dre_rev is not None: dre_list.append(dre_rev)
-        dre_out = _build_category(df_out, 'Outras Saídas', lambda c: (c in other_explicit) or any(c.startswith(p) for p in other_prefix))
-        if dre_out is not None: dre_list.append(dre_out)
+            df_out['IPI'] = df_out['Valor IPI Nota'].fillna(0.0) if 'Valor IPI Nota' in df_out.columns else 0.0
+        # CFOP limpo uma vez por frame; cada categoria vira uma máscara
+        # isin/startswith em C, em vez de um lambda por linha por categoria
+        cfop_out = df_out['CFOP'].astype(str).str.replace('.', '', regex=False)
+        rows = _dre_rows(df_out,
+                         [cfop_out.isin(_DRE_REVENUE_CFOPS),
+                          cfop_out.isin(_DRE_OTHER_CFOPS) | cfop_out.str.startswith(_DRE_OTHER_PREFIXES)],
+                         ['Receita', 'Outras Saídas'])
+        if rows is not None: dre_list.append(rows)
 
     if not df_entries.empty:
         df_in = df_entries.copy()
         if 'Valor Contábil' not in df_in.columns:
-            df_in['Valor Contábil'] = pd.to_numeric(df_in.get('Valor Total Item', 0), errors='coerce').fillna(0.0)
+            df_in['Valor Contábil'] = df_in['Valor Total Item'].fillna(0.0) if 'Valor Total Item' in df_in.columns else 0.0
         if 'ICMS' not in df_in.columns:
-            df_in['ICMS'] = pd.to_numeric(df_in.get('Valor ICMS Item', 0), errors='coerce').fillna(0.0)
+            df_in['ICMS'] = df_in['Valor ICMS Item'].fillna(0.0) if 'Valor ICMS Item' in df_in.columns else 0.0
         if 'IPI' not in df_in.columns:
-            df_in['IPI'] = pd.to_numeric(df_in.get('Valor IPI Item', 0), errors='coerce').fillna(0.0)
-        dre_cost = _build_category(df_in, 'Custos', lambda c: c in cost_cfops)
-        if dre_cost is not None: dre_list.append(dre_cost)
-        dre_exp = _build_category(df_in, 'Despesas', lambda c: c in expense_cfops)
-        if dre_exp is not None: dre_list.append(dre_exp)
+            df_in['IPI'] = df_in['Valor IPI Item'].fillna(0.0) if 'Valor IPI Item' in df_in.columns else 0.0
+        cfop_in = df_in['CFOP'].astype(str).str.replace('.', '', regex=False)
+        rows = _dre_rows(df_in,
+                         [cfop_in.isin(_DRE_COST_CFOPS), cfop_in.isin(_DRE_EXPENSE_CFOPS)],
+                         ['Custos', 'Despesas'])
+        if rows is not None: dre_list.append(rows)
 
     if dre_list:
-        df_dre = pd.concat(dre_list, ignore_index=True)
-        order = ['Receita','Outras Saídas','Custos','Despesas']
-        df_dre['Categoria'] = pd.Categorical(df_dre['Categoria'], categories=order, ordered=True)
+        base = pd.concat(dre_list, ignore_index=True)
+        for c in ['Valor Contábil','ICMS','IPI']:
+            if c in base.columns: base[c] = base[c].fillna(0.0)
+        gcols = [c for c in ['Competência','CNPJ','Razão Social'] if c in base.columns]
+        if not gcols: gcols = ['Competência']
+        # Chaves de baixíssima cardinalidade: como category, o groupby
+        # opera sobre códigos inteiros em vez de hashear str por linha
+        for c in gcols:
+            base[c] = base[c].astype('category')
+        base['Categoria'] = pd.Categorical(base['Categoria'], categories=dre_order, ordered=True)
+        # sort=False: a ordenação visível é a do sort_values logo abaixo
+        df_dre = (base.groupby(gcols + ['Categoria'], observed=True, sort=False)
+                      .agg({'Valor Contábil':'sum','ICMS':'sum','IPI':'sum'})
+                      .reset_index())
+        df_dre['Total Impostos'] = df_dre['ICMS'] + df_dre['IPI']
+        # Mantém o layout histórico da aba (Categoria depois dos valores)
+        df_dre = df_dre[gcols + ['Valor Contábil','ICMS','IPI','Categoria','Total Impostos']]
         sort_cols = [c for c in ['Competência','CNPJ','Razão Social','Categoria'] if c in df_dre.columns]
         df_dre = df_dre.sort_values(sort_cols).reset_index(drop=True)
         sheets['DRE Fiscal'] = df_dre
@@ -690,21 +1214,27 @@ def aggregate_records(records: List[SpedRecord]) -> Dict[str, pd.DataFrame]:
         # KPIs
         kpi_df = df_dre.copy()
         kpi_df['Competência'] = kpi_df['Competência'].fillna('Sem competência').astype(str)
-        rows = []
         gcols = [c for c in ['Competência','CNPJ','Razão Social'] if c in kpi_df.columns]
         if not gcols: gcols = ['Competência']
-        for keys, grp in kpi_df.groupby(gcols):
-            if not isinstance(keys, tuple): keys = (keys,)
-            key_map = {gcols[i]: keys[i] for i in range(len(gcols))}
-            rev = grp.loc[grp['Categoria']=='Receita','Valor Contábil'].sum()
-            cost = grp.loc[grp['Categoria']=='Custos','Valor Contábil'].sum()
-            taxes = grp.loc[grp['Categoria']=='Receita','Total Impostos'].sum()
-            margem = rev - cost
-            carga = (taxes/rev*100.0) if rev>0 else 0.0
-            row = {'Receita':rev,'Custos':cost,'Margem Bruta':margem,'Total Impostos':taxes,'Carga Tributária Efetiva (%)':carga}
-            row.update(key_map)
-            rows.append(row)
-        df_kpi = pd.DataFrame(rows)
+        # Um pivot por (grupo x categoria) substitui o laço por grupo com
+        # quatro somas filtradas cada; as colunas derivadas saem vetorizadas.
+        # observed=True: com chaves categóricas, observed=False expandiria o
+        # produto cartesiano dos grupos (linhas zeradas cruzando CNPJ de uma
+        # empresa com Razão Social de outra); _pv_col já repõe categorias
+        # ausentes com zero
+        pv = kpi_df.pivot_table(index=gcols, columns='Categoria',
+                                values=['Valor Contábil','Total Impostos'],
+                                aggfunc='sum', fill_value=0.0, observed=True)
+        def _pv_col(top: str, cat: str) -> pd.Series:
+            return pv[(top, cat)] if (top, cat) in pv.columns else pd.Series(0.0, index=pv.index)
+        receita = _pv_col('Valor Contábil', 'Receita')
+        custos = _pv_col('Valor Contábil', 'Custos')
+        impostos = _pv_col('Total Impostos', 'Receita')
+        df_kpi = pd.DataFrame({
+            'Receita': receita, 'Custos': custos, 'Margem Bruta': receita - custos,
+            'Total Impostos': impostos,
+            'Carga Tributária Efetiva (%)': np.where(receita > 0, impostos / receita.where(receita > 0, 1.0) * 100.0, 0.0),
+        }).reset_index()
         cols = [c for c in ['Competência','CNPJ','Razão Social'] if c in df_kpi.columns] + ['Receita','Custos','Margem Bruta','Total Impostos','Carga Tributária Efetiva (%)']
         df_kpi = df_kpi[cols]
         sheets['Indicadores Fiscais'] = df_kpi
@@ -717,14 +1247,25 @@ def aggregate_records(records: List[SpedRecord]) -> Dict[str, pd.DataFrame]:
 
 def build_excel_bytes(sheets: Dict[str, pd.DataFrame]) -> bytes:
     bio = io.BytesIO()
-    with pd.ExcelWriter(bio, engine='xlsxwriter') as writer:
+    # constant_memory não serve aqui: o to_excel emite as células coluna a
+    # coluna, e o modo descarta em silêncio escritas em linhas já despejadas
+    # — só a primeira coluna sobreviveria
+    # strings_to_urls=False poupa o teste de URL que o xlsxwriter faria em
+    # cada célula de texto; o relatório não tem hyperlinks
+    with pd.ExcelWriter(bio, engine='xlsxwriter',
+                        engine_kwargs={'options': {'strings_to_urls': False}}) as writer:
         for name, df in sheets.items():
             wsname = name[:31]
             df.to_excel(writer, sheet_name=wsname, index=False)
             ws = writer.sheets[wsname]
             ws.freeze_panes(1,0); ws.set_zoom(90)
+            # Largura por coluna com str.len vetorizado sobre as primeiras
+            # 10k linhas — a largura é cosmética e a cauda quase nunca muda
+            # o resultado; antes cada célula virava str em um generator
+            sample = df.head(10000)
             for i, col in enumerate(df.columns):
-                max_len = max((len(str(x)) for x in [col] + df[col].astype(str).tolist()), default=0)
+                cell_max = sample[col].astype(str).str.len().max() if len(sample) else 0
+                max_len = max(len(str(col)), int(cell_max) if pd.notna(cell_max) else 0)
                 ws.set_column(i, i, min(max(max_len+2, 12), 60))
     bio.seek(0)
     return bio.read()
@@ -733,6 +1274,23 @@ def build_excel_bytes(sheets: Dict[str, pd.DataFrame]) -> bytes:
 # App Streamlit
 # -------------------------
 
+# Caches por conteúdo: reexecutar a auditoria com os mesmos uploads (caso
+# comum ao ajustar apenas os SPEDs) não reparseia TIPI nem XMLs — o
+# st.cache_data chaveia pelo hash dos bytes enviados
+@st.cache_data(show_spinner=False)
+def _tipi_from_upload(name: str, data: bytes) -> Dict[str, float]:
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1]) as tf:
+        tf.write(data); tf.flush()
+        return load_tipi_table(tf.name)
+
+@st.cache_data(show_spinner=False)
+def _xml_map_from_payload(named_blobs: tuple) -> Dict[str, Dict[str, any]]:
+    return xml_map_from_blobs(named_blobs)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _sped_records_from_payload(named_blobs: tuple, tipi: Dict[str, float]) -> List[tuple]:
+    return parse_sped_many(list(named_blobs), tipi)
+
 st.set_page_config(page_title="SPED Analyzer ICMS e IPI", layout="centered")
 st.title("SPED Analyzer ICMS e IPI")
 st.write("Auditoria de arquivos SPED ICMS/IPI (sem gravação em disco).")
@@ -749,56 +1307,29 @@ if st.button("Executar Auditoria"):
             # TIPI
             tipi_map: Dict[str, float] = {}
             if tipi_file is not None:
-                with tempfile.NamedTemporaryFile(suffix=os.path.splitext(tipi_file.name)[1]) as tf:
-                    tf.write(tipi_file.getbuffer()); tf.flush()
-                    try:
-                        tipi_map = load_tipi_table(tf.name)
-                    except Exception as exc:
-                        st.warning(f"Falha ao carregar TIPI: {exc}")
-                        tipi_map = {}
-
-            # XMLs
-            xml_map: Dict[str, Dict[str, any]] = {}
-            for up in (xml_files or []):
-                name = up.name.lower()
-                if name.endswith('.xml'):
-                    try:
-                        d = parse_xml_nfe_bytes(up.getbuffer())
-                        if not d or 'Chave' not in d:
-                            d = parse_xml_cte_bytes(up.getbuffer())
-                        if d and 'Chave' in d:
-                            xml_map[d['Chave']] = d
-                    except Exception:
-                        pass
-                elif name.endswith('.zip'):
-                    try:
-                        with zipfile.ZipFile(io.BytesIO(up.getbuffer())) as zf:
-                            for nm in zf.namelist():
-                                if nm.lower().endswith('.xml'):
-                                    try:
-                                        b = zf.read(nm)
-                                        d = parse_xml_nfe_bytes(b)
-                                        if not d or 'Chave' not in d:
-                                            d = parse_xml_cte_bytes(b)
-                                        if d and 'Chave' in d:
-                                            xml_map[d['Chave']] = d
-                                    except Exception:
-                                        pass
-                    except Exception:
-                        pass
-
-            # SPEDs
-            records: List[SpedRecord] = []
-            for up in sped_files:
                 try:
-                    rec = parse_sped_bytes(up.name, up.getbuffer(), xml_map, tipi_map)
-                    records.append(rec)
+                    tipi_map = _tipi_from_upload(tipi_file.name, bytes(tipi_file.getbuffer()))
                 except Exception as exc:
-                    st.error(f"Erro ao processar {up.name}: {exc}")
+                    st.warning(f"Falha ao carregar TIPI: {exc}")
+                    tipi_map = {}
+
+            # XMLs (cacheados pelo conteúdo dos uploads)
+            xml_map: Dict[str, Dict[str, any]] = _xml_map_from_payload(
+                tuple((up.name, bytes(up.getbuffer())) for up in (xml_files or [])))
+
+            # SPEDs (em paralelo quando há mais de um arquivo, cacheados
+            # pelo conteúdo dos uploads e pela TIPI em vigor)
+            records: List[SpedRecord] = []
+            for name, rec, err in _sped_records_from_payload(
+                    tuple((up.name, bytes(up.getbuffer())) for up in sped_files), tipi_map):
+                if err is not None:
+                    st.error(f"Erro ao processar {name}: {err}")
+                else:
+                    records.append(rec)
             if not records:
                 st.error("Nenhum arquivo SPED processado.")
             else:
-                sheets = aggregate_records(records)
+                sheets = aggregate_records(records, xml_map)
                 excel_bytes = build_excel_bytes(sheets)
                 st.success("Relatório gerado com sucesso!")
                 st.download_button(